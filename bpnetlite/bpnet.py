@@ -392,10 +392,13 @@ class BPNet(torch.nn.Module):
 			for data in training_data:
 				if len(data) == 3:
 					X, X_ctl, y = data
-					X, X_ctl, y = X.cuda(), X_ctl.cuda(), y.cuda()
+					X = X.cuda(non_blocking=True).float()
+					X_ctl = X_ctl.cuda(non_blocking=True)
+					y = y.cuda(non_blocking=True)
 				else:
 					X, y = data
-					X, y = X.cuda(), y.cuda()
+					X = X.cuda(non_blocking=True).float()
+					y = y.cuda(non_blocking=True)
 					X_ctl = None
 
 				# Clear the optimizer and set the model to training mode
@@ -192,8 +192,8 @@ class ChromBPNet(torch.nn.Module):
 			for iteration, (X, y) in enumerate(training_data):
 				self.accessibility.train()
 
-				X = X.cuda()
-				y = y.cuda()
+				X = X.cuda(non_blocking=True).float()
+				y = y.cuda(non_blocking=True)
 
 				optimizer.zero_grad()
 
@@ -2,11 +2,198 @@
 # Author: Jacob Schreiber <jmschreiber91@gmail.com>
 # Code adapted from Alex Tseng, Avanti Shrikumar, and Ziga Avsec
 
+import os
 import numpy
 import torch
+import warnings
+import pandas
+import pyfaidx
+import pyBigWig
 
 from tqdm import tqdm
 from tangermeme.io import extract_loci
+from tangermeme.io import one_hot_encode
+
+
+# Upper-cases a, c, g, and t and maps every other character to N
+_ACGT_TABLE = str.maketrans({chr(i): 'N' for i in range(256)})
+_ACGT_TABLE.update(str.maketrans('ACGTacgt', 'ACGTACGT'))
+
+
+def one_hot_encode_fasta(filename, chroms=None, cache_dir=None, verbose=False):
+	"""One-hot encode each chromosome in a FASTA file once.
+
+	Extracting loci from a FASTA file re-encodes the underlying sequence for
+	every locus, which is wasteful when many loci fall on the same
+	chromosome or when the same genome is used for both training and
+	validation. This function encodes each chromosome a single time and
+	returns a dictionary that can be passed in as `sequences` to
+	`PeakGenerator` or `extract_loci`, where loci are then simply slices of
+	the pre-encoded arrays.
+
+	Because entire chromosomes are encoded, any character other than A, C,
+	G, or T, such as the IUPAC ambiguity codes present in some reference
+	genomes, is treated as an N and encoded as all zeroes rather than
+	raising an error.
+
+	Parameters
+	----------
+	filename: str
+		The path to a FASTA file to read from.
+
+	chroms: list or None, optional
+		A set of chromosomes to encode. If None, encode every chromosome in
+		the FASTA file. Default is None.
+
+	cache_dir: str or None, optional
+		A folder to store the encoded chromosomes in as `{chrom}.npy` files.
+		Chromosomes that already have a file there are not re-encoded and are
+		instead opened as read-only memory maps, so repeated runs on the same
+		genome only pay for the encoding once. A cached file that cannot be
+		read or whose length does not match the chromosome in the FASTA file
+		is re-encoded and overwritten. Files are written under a temporary
+		name and then moved into place, so an interrupted run does not leave
+		a partial file behind. The folder is keyed only on chromosome names
+		and so should not be shared between genomes. If None, nothing is
+		written to disk. Default is None.
+
+	verbose: bool, optional
+		Whether to display a progress bar over chromosomes. Default is False.
+
+	Returns
+	-------
+	sequences: dict
+		A dictionary where the keys are chromosome names and the values are
+		one-hot encoded numpy arrays, or memory maps when `cache_dir` is
+		given, of shape (4, chrom_length). When `cache_dir` is None every
+		requested chromosome is held in memory as int8, which is roughly
+		12 GB for the entire hg38 genome.
+	"""
+
+	if cache_dir is not None:
+		os.makedirs(cache_dir, exist_ok=True)
+
+	fasta = pyfaidx.Fasta(filename)
+	if chroms is None:
+		chroms = list(fasta.keys())
+
+	sequences = {}
+	for chrom in tqdm(chroms, disable=not verbose):
+		if cache_dir is not None:
+			path = os.path.join(cache_dir, "{}.npy".format(chrom))
+			if os.path.exists(path):
+				try:
+					X = numpy.load(path, mmap_mode='r')
+				except (ValueError, OSError):
+					X = None
+
+				if X is not None and X.shape == (4, len(fasta[chrom])):
+					sequences[chrom] = X
+					continue
+
+		sequence = fasta[chrom][:].seq.translate(_ACGT_TABLE)
+		sequences[chrom] = one_hot_encode(sequence, ignore=['N']).numpy()
+
+		if cache_dir is not None:
+			tmp_path = "{}.{}.tmp".format(path, os.getpid())
+			with open(tmp_path, "wb") as outfile:
+				numpy.save(outfile, sequences[chrom])
+
+			os.replace(tmp_path, path)
+			sequences[chrom] = numpy.load(path, mmap_mode='r')
+
+	fasta.close()
+	return sequences
+
+
+def read_bigwig(filename, chroms=None, chrom_sizes=None, verbose=False):
+	"""Read the signal of each chromosome in a bigWig file once.
+
+	Extracting loci from a bigWig file issues one query per locus and per
+	track. This function instead reads each requested chromosome in a single
+	query and returns a dictionary that can be passed in as one of the
+	`signals` or `controls` to `PeakGenerator` or `extract_loci`, where loci
+	are then simply slices of the pre-read arrays. Missing values are
+	replaced with zeroes.
+
+	Sparse bigWig files, such as control or single-strand tracks, often leave
+	out chromosomes without any reads. A requested chromosome that is not in
+	the bigWig file is filled with zeroes if its length is given in
+	`chrom_sizes` and is otherwise left out of the returned dictionary. A
+	warning is raised in both cases.
+
+	Parameters
+	----------
+	filename: str
+		The path to a bigWig file to read from.
+
+	chroms: list or None, optional
+		A set of chromosomes to read. If None, read every chromosome in the
+		bigWig file. Default is None.
+
+	chrom_sizes: dict or None, optional
+		A dictionary mapping chromosome names to lengths, used to zero-fill
+		requested chromosomes that are missing from the bigWig file. If None,
+		such chromosomes are skipped. Default is None.
+
+	verbose: bool, optional
+		Whether to display a progress bar over chromosomes. Default is False.
+
+	Returns
+	-------
+	signal: dict
+		A dictionary where the keys are chromosome names and the values are
+		numpy arrays of shape (chrom_length,). Every requested chromosome is
+		held in memory as float32, which is roughly 12 GB for the entire hg38
+		genome.
+	"""
+
+	bw = pyBigWig.open(filename)
+	bw_chrom_sizes = bw.chroms()
+	if chroms is None:
+		chroms = list(bw_chrom_sizes.keys())
+
+	signal = {}
+	for chrom in tqdm(chroms, disable=not verbose):
+		if chrom in bw_chrom_sizes:
+			values = bw.values(chrom, 0, bw_chrom_sizes[chrom], numpy=True)
+			signal[chrom] = numpy.nan_to_num(values, copy=False)
+		elif chrom_sizes is not None and chrom in chrom_sizes:
+			warnings.warn("Chromosome {} is not in {}, filling with "
+				"zeroes.".format(chrom, filename))
+			signal[chrom] = numpy.zeros(chrom_sizes[chrom], dtype='float32')
+		else:
+			warnings.warn("Chromosome {} is not in {}, skipping.".format(
+				chrom, filename))
+
+	bw.close()
+	return signal
+
+
+def _read_loci(loci):
+	"""Read any bed files in a set of loci into DataFrames."""
+
+	if isinstance(loci, (list, tuple)):
+		return [_read_loci(loci_) for loci_ in loci]
+
+	if isinstance(loci, str):
+		return pandas.read_csv(loci, sep='\t', usecols=[0, 1, 2], header=None,
+			index_col=False, names=['chrom', 'start', 'end'], 
+			dtype={'chrom': str})
+
+	return loci
+
+
+def _chrom_sizes(sequences):
+	"""Return the length of each chromosome in a fasta file or dictionary."""
+
+	if isinstance(sequences, str):
+		fasta = pyfaidx.Fasta(sequences)
+		chrom_sizes = {chrom: len(fasta[chrom]) for chrom in fasta.keys()}
+		fasta.close()
+		return chrom_sizes
+
+	return {chrom: X.shape[-1] for chrom, X in sequences.items()}
 
 
 class DataGenerator(torch.utils.data.Dataset):
@@ -27,6 +214,8 @@ class DataGenerator(torch.utils.data.Dataset):
 	sequences: torch.tensor, shape=(n, 4, in_window+2*max_jitter)
 		A one-hot encoded tensor of `n` example sequences, each of input 
 		length `in_window`. See description above for connection with jitter.
+		Sequences are returned in the dtype they are stored in, usually int8,
+		and should be cast to float right before being passed into a model.
 
 	signals: torch.tensor, shape=(n, t, out_window+2*max_jitter)
 		The signals to predict, usually counts, for `n` examples with
@@ -54,11 +243,17 @@ class DataGenerator(torch.utils.data.Dataset):
 
 	random_state: int or None, optional
 		Whether to use a deterministic seed or not.
+
+	device: str or torch.device, optional
+		The device to store the sequences, signals, and controls on. When a
+		GPU is used, the whole data set is moved there once and each example
+		is sliced and augmented on the device, removing the per-batch copy
+		from host memory. Default is 'cpu'.
 	"""
 
 	def __init__(self, sequences, signals, controls=None, in_window=2114, 
 		out_window=1000, max_jitter=0, reverse_complement=False, 
-		random_state=None):
+		random_state=None, device='cpu'):
 		self.in_window = in_window
 		self.out_window = out_window
 		self.max_jitter = max_jitter
@@ -66,9 +261,9 @@ class DataGenerator(torch.utils.data.Dataset):
 		self.reverse_complement = reverse_complement
 		self.random_state = numpy.random.RandomState(random_state)
 
-		self.signals = signals
-		self.controls = controls
-		self.sequences = sequences	
+		self.signals = signals.to(device)
+		self.controls = controls.to(device) if controls is not None else None
+		self.sequences = sequences.to(device)
 
 	def __len__(self):
 		return len(self.sequences)
@@ -97,10 +292,70 @@ class DataGenerator(torch.utils.data.Dataset):
 		return X, y		
 
 
+class CUDAPrefetcher(object):
+	"""A wrapper that copies the next batch to the GPU in the background.
+
+	A DataLoader can prepare batches ahead of time in worker processes, but
+	the copy of each batch from host memory to the GPU still happens on the
+	default stream when the training loop asks for it. This wrapper issues
+	the copy of the next batch on a separate CUDA stream while the model is
+	working on the current one, so that the transfer overlaps with the
+	forward and backward passes. The copies are only truly asynchronous if
+	the wrapped DataLoader uses pinned memory.
+
+	Parameters
+	----------
+	loader: torch.utils.data.DataLoader
+		A DataLoader, usually one returned by `PeakGenerator`, that yields
+		tuples of tensors.
+
+	device: str or torch.device, optional
+		The GPU to copy batches onto. Default is 'cuda'.
+	"""
+
+	def __init__(self, loader, device='cuda'):
+		self.loader = loader
+		self.dataset = loader.dataset
+		self.device = device
+		self.stream = torch.cuda.Stream(device=device)
+
+	def __len__(self):
+		return len(self.loader)
+
+	def __iter__(self):
+		self.iter = iter(self.loader)
+		self.preload()
+		return self
+
+	def preload(self):
+		try:
+			batch = next(self.iter)
+		except StopIteration:
+			self.next_batch = None
+			return
+
+		with torch.cuda.stream(self.stream):
+			self.next_batch = tuple(X.to(self.device, non_blocking=True) 
+				for X in batch)
+
+	def __next__(self):
+		torch.cuda.current_stream().wait_stream(self.stream)
+		batch = self.next_batch
+		if batch is None:
+			raise StopIteration
+
+		for X in batch:
+			X.record_stream(torch.cuda.current_stream())
+
+		self.preload()
+		return batch
+
+
 def PeakGenerator(loci, sequences, signals, controls=None, chroms=None, 
 	in_window=2114, out_window=1000, max_jitter=128, reverse_complement=True, 
 	min_counts=None, max_counts=None, random_state=None, pin_memory=True, 
-	num_workers=0, batch_size=32, verbose=False):
+	num_workers=0, batch_size=32, device='cpu', prefetch_to_gpu=False, 
+	sequence_cache_dir=None, preload_signals=False, verbose=False):
 	"""This is a constructor function that handles all IO.
 
 	This function will extract signal from all signal and control files,
@@ -119,13 +374,14 @@ def PeakGenerator(loci, sequences, signals, controls=None, chroms=None,
 	sequences: str or dictionary
 		Either the path to a fasta file to read from or a dictionary where the
 		keys are the unique set of chromosoms and the values are one-hot
-		encoded sequences as numpy arrays or memory maps.
+		encoded sequences as numpy arrays or memory maps. Such a dictionary
+		can be built once using `one_hot_encode_fasta` and reused.
 
 	signals: list of strs or list of dictionaries
 		A list of filepaths to bigwig files, where each filepath will be read
 		using pyBigWig, or a list of dictionaries where the keys are the same
 		set of unique chromosomes and the values are numpy arrays or memory
-		maps.
+		maps. Such dictionaries can be built once using `read_bigwig`.
 
 	controls: list of strs or list of dictionaries or None, optional
 		A list of filepaths to bigwig files, where each filepath will be read
@@ -174,16 +430,77 @@ def PeakGenerator(loci, sequences, signals, controls=None, chroms=None,
 
 	batch_size: int, optional
 		The number of data elements per batch. Default is 32.
+
+	device: str or torch.device, optional
+		The device to preload the extracted data onto. If the data set fits
+		in GPU memory, passing 'cuda' removes the host-to-device copy of each
+		batch during training. Because tensors already on a GPU cannot be
+		pinned or shared with worker processes, `pin_memory` and
+		`num_workers` are ignored in that case. Default is 'cpu'.
+
+	prefetch_to_gpu: bool, optional
+		Whether to wrap the DataLoader in a `CUDAPrefetcher` so that each
+		batch is copied to the GPU on a side stream while the previous batch
+		is being used. This is useful when the data set is too large to
+		preload using `device`. Batches are copied to the default GPU. When
+		`device` is already a GPU the batches are on the device and no
+		wrapping is done. Default is False.
+
+	sequence_cache_dir: str or None, optional
+		When `sequences` is the path to a fasta file, a folder in which to
+		keep one-hot encoded chromosomes as `.npy` files using
+		`one_hot_encode_fasta`. The first run writes the files and later runs
+		memory map them instead of parsing and encoding the fasta file. Only
+		the chromosomes in `chroms` are encoded when it is given. If None,
+		sequences are read from the fasta file directly. Default is None.
+
+	preload_signals: bool, optional
+		Whether to read each chromosome referenced by `loci` once from every
+		bigWig file in `signals` and `controls` using `read_bigwig`, instead
+		of querying the files once per locus. This is much faster when there
+		are many loci but holds the referenced chromosomes of every track in
+		memory as float32. Bed files in `loci` are read once here and passed
+		on as DataFrames, and chromosomes missing from a bigWig file are
+		filled with zeroes. Default is False.
 	
 	verbose: bool, optional
 		Whether to display a progress bar while loading. Default is False.
 
 	Returns
 	-------
-	X: torch.utils.data.DataLoader
-		A PyTorch DataLoader wrapped DataGenerator object.
+	X: torch.utils.data.DataLoader or CUDAPrefetcher
+		A PyTorch DataLoader wrapped DataGenerator object, additionally
+		wrapped in a CUDAPrefetcher if `prefetch_to_gpu` is True. The
+		sequences in each batch are one-hot encoded int8 tensors, not
+		float32, and must be cast using `.float()` before being passed into
+		a model. `BPNet.fit` and `ChromBPNet.fit` do this automatically.
 	"""
 
+	if sequence_cache_dir is not None and isinstance(sequences, str):
+		sequences = one_hot_encode_fasta(sequences, chroms=chroms, 
+			cache_dir=sequence_cache_dir, verbose=verbose)
+
+	if preload_signals:
+		loci = _read_loci(loci)
+		loci_ = loci if isinstance(loci, list) else [loci]
+
+		signal_chroms = set().union(*[set(df.iloc[:, 0]) for df in loci_])
+		if chroms is not None:
+			signal_chroms = signal_chroms.intersection(chroms)
+
+		signal_chroms = sorted(signal_chroms)
+		chrom_sizes = _chrom_sizes(sequences)
+
+		signals = [read_bigwig(signal, chroms=signal_chroms, 
+			chrom_sizes=chrom_sizes, verbose=verbose) 
+			if isinstance(signal, str) else signal for signal in signals]
+
+		if controls is not None:
+			controls = [read_bigwig(control, chroms=signal_chroms, 
+				chrom_sizes=chrom_sizes, verbose=verbose) 
+				if isinstance(control, str) else control 
+				for control in controls]
+
 	X = extract_loci(loci=loci, sequences=sequences, signals=signals, 
 		in_signals=controls, chroms=chroms, in_window=in_window, 
 		out_window=out_window, max_jitter=max_jitter, min_counts=min_counts,
@@ -195,13 +512,19 @@ def PeakGenerator(loci, sequences, signals, controls=None, chroms=None,
 		sequences, signals_ = X
 		controls_ = None
 
-	sequences = sequences.float()
-
 	X_gen = DataGenerator(sequences, signals_, controls=controls_, 
 		in_window=in_window, out_window=out_window, max_jitter=max_jitter,
-		reverse_complement=reverse_complement, random_state=random_state)
+		reverse_complement=reverse_complement, random_state=random_state,
+		device=device)
+
+	device_type = torch.device(device).type
+	if device_type != 'cpu':
+		pin_memory, num_workers = False, 0
 
 	X_gen = torch.utils.data.DataLoader(X_gen, pin_memory=pin_memory,
 		num_workers=num_workers, batch_size=batch_size) 
 
+	if prefetch_to_gpu and device_type != 'cuda':
+		X_gen = CUDAPrefetcher(X_gen, device='cuda')
+
 	return X_gen
@@ -156,6 +156,17 @@ def marginalization_report(model, motifs, X, output_dir, batch_size=64,
 	ap_before, ap_after, ap_diff = [], [], []
 	ac_before, ac_after, ac_diff = [], [], []
 
+	if attributions:
+		X_attr = X.double()
+		profile_wrapper = ProfileWrapper(model)
+		count_wrapper = CountWrapper(model)
+
+		nonlinear_ops = {
+			_ProfileLogitScaling: _nonlinear,
+			_Log: _nonlinear,
+			_Exp: _nonlinear
+		}
+
 	for i, (name, pwm) in tqdm(enumerate(motifs), disable=not verbose):
 		motif = ''.join(numpy.array(['A', 'C', 'G', 'T'])[pwm.argmax(axis=1)])
 
@@ -175,23 +186,14 @@ def marginalization_report(model, motifs, X, output_dir, batch_size=64,
 		c_after.append(y_counts_after)
 
 		if attributions:
-			Xp_attr_before, Xp_attr_after = marginalize(ProfileWrapper(
-				model.double()), X.double(), motif, func=deep_lift_shap, 
-				additional_nonlinear_ops={
-					_ProfileLogitScaling: _nonlinear,
-					_Log: _nonlinear,
-					_Exp: _nonlinear
-				}, 
-				n_shuffles=1, batch_size=batch_size)
+			Xp_attr_before, Xp_attr_after = marginalize(
+				profile_wrapper.double(), X_attr, motif, func=deep_lift_shap, 
+				additional_nonlinear_ops=nonlinear_ops, n_shuffles=1, 
+				batch_size=batch_size)
 
 			Xc_attr_before, Xc_attr_after = marginalize(
-				CountWrapper(model).double(), X.double(), motif, 
-				func=deep_lift_shap, n_shuffles=1,
-				additional_nonlinear_ops={
-					_ProfileLogitScaling: _nonlinear,
-					_Log: _nonlinear,
-					_Exp: _nonlinear
-				}, 
+				count_wrapper.double(), X_attr, motif, func=deep_lift_shap, 
+				additional_nonlinear_ops=nonlinear_ops, n_shuffles=1, 
 				batch_size=batch_size)
 
 			ap_before.append(Xp_attr_before.mean(axis=0)[:, s:e].T)